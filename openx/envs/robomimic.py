@@ -1,6 +1,9 @@
+import copy
 import json
 import os
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 import gymnasium as gym
 import h5py
@@ -10,8 +13,133 @@ from robomimic.utils import env_utils
 
 from openx.data.utils import StateEncoding
 
+try:
+    import numba
+
+    NUMBA_IMPORTED = True
+except ModuleNotFoundError:
+    NUMBA_IMPORTED = False
+
 OBJECT_STATE_SIZE = 44  # Set to the max size across robomimic envs. ToolHang is giant.
 
+# Maps dataset path to (mtime, env_args json) so repeated env construction doesn't re-open the file.
+_env_meta_cache: Dict[str, Tuple[Optional[float], str]] = {}
+
+
+def _get_mtime(path: str) -> Optional[float]:
+    # Only local files can be cheaply checked for modification, remote files are assumed to be static.
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def _read_env_args(path: str) -> Tuple[Optional[float], str]:
+    mtime = _get_mtime(path)
+    # Copy env meta code to allow reading from gcp file systems
+    with h5py.File(tf.io.gfile.GFile(path, "rb"), "r") as f:
+        return mtime, f["data"].attrs["env_args"]
+
+
+def preload_env_metas(paths: List[str], max_workers: int = 16):
+    """Reads the env metadata of all given datasets in parallel into this process's cache, so that constructing
+    many RobomimicEnvs afterwards in the same process does not pay a (possibly remote) file open per env.
+
+    The cache is module level state, so this does not help envs built in other processes, e.g. the workers of
+    gym.vector.AsyncVectorEnv (which uses the spawn context in scripts/test.py).
+    """
+    paths = list({os.path.expanduser(path) for path in paths})
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+        for path, cached in zip(paths, executor.map(_read_env_args, paths), strict=True):
+            _env_meta_cache[path] = cached
+
+
+def _load_env_meta(path: str) -> Dict:
+    cached = _env_meta_cache.get(path)
+    if cached is None or cached[0] != _get_mtime(path):
+        cached = _read_env_args(path)
+        _env_meta_cache[path] = cached
+    # Parse every time so callers never share (and mutate) the same dict.
+    return json.loads(cached[1])
+
+
+if NUMBA_IMPORTED:
+    # njit does not bounds check, so the shapes are asserted explicitly.
+    @numba.njit(cache=True)
+    def _pack_and_clip(out, ee_pos, ee_euler, gripper, low, high):
+        assert ee_pos.shape[0] == 3 and ee_euler.shape[0] == 3 and gripper.shape[0] == 1
+        assert out.shape[0] == 7 and low.shape[0] == 7 and high.shape[0] == 7
+        for i in range(3):
+            out[i] = ee_pos[i]
+            out[3 + i] = ee_euler[i]
+        out[6] = gripper[0]
+        for i in range(out.shape[0]):
+            out[i] = min(max(out[i], low[i]), high[i])
+
+    @numba.njit(cache=True)
+    def _pad_obj_state(dst, src, prev_n):
+        n = src.shape[0]
+        assert n <= dst.shape[0] and prev_n <= dst.shape[0]
+        for i in range(n):
+            dst[i] = src[i]
+        for i in range(n, prev_n):
+            dst[i] = 0.0
+
+else:
+
+    def _pack_and_clip(out, ee_pos, ee_euler, gripper, low, high):
+        out[0:3] = ee_pos
+        out[3:6] = ee_euler
+        out[6:7] = gripper
+        np.clip(out, low, high, out=out)
+
+    def _pad_obj_state(dst, src, prev_n):
+        n = src.shape[0]
+        dst[:n] = src
+        if prev_n > n:
+            dst[n:prev_n] = 0.0
+
+
+@lru_cache(maxsize=None)
+def _build_spaces(use_image_obs: bool, low: Tuple[float, ...], high: Tuple[float, ...]):
+    # Spaces only depend on these arguments, so they are built once and copied for each env instance.
+    low, high = np.array(low, dtype=np.float32), np.array(high, dtype=np.float32)
+    observation_spaces = dict(
+        state=gym.spaces.Dict(
+            {
+                StateEncoding.EE_POS: gym.spaces.Box(shape=(3,), low=-np.inf, high=np.inf, dtype=np.float32),
+                StateEncoding.EE_QUAT: gym.spaces.Box(shape=(4,), low=-np.inf, high=np.inf, dtype=np.float32),
+                StateEncoding.GRIPPER: gym.spaces.Box(shape=(1,), low=-np.inf, high=np.inf, dtype=np.float32),
+                StateEncoding.JOINT_POS: gym.spaces.Box(shape=(7,), low=-np.inf, high=np.inf, dtype=np.float32),
+                StateEncoding.JOINT_VEL: gym.spaces.Box(shape=(7,), low=-np.inf, high=np.inf, dtype=np.float32),
+                StateEncoding.MISC: gym.spaces.Box(
+                    shape=(OBJECT_STATE_SIZE,), low=-np.inf, high=np.inf, dtype=np.float32
+                ),
+            }
+        ),
+    )
+
+    if use_image_obs:
+        observation_spaces["image"] = gym.spaces.Dict(
+            dict(
+                agent=gym.spaces.Box(shape=(84, 84, 3), dtype=np.uint8, low=0, high=255),
+                wrist=gym.spaces.Box(shape=(84, 84, 3), dtype=np.uint8, low=0, high=255),
+            )
+        )
+
+    observation_space = gym.spaces.Dict(observation_spaces)
+    action_space = gym.spaces.Dict(
+        dict(
+            desired_delta=gym.spaces.Dict(
+                {
+                    StateEncoding.EE_POS: gym.spaces.Box(shape=(3,), low=low[:3], high=high[:3], dtype=np.float32),
+                    StateEncoding.EE_EULER: gym.spaces.Box(shape=(3,), low=low[3:6], high=high[3:6], dtype=np.float32),
+                }
+            ),
+            desired_absolute=gym.spaces.Dict(
+                {StateEncoding.GRIPPER: gym.spaces.Box(shape=(1,), low=low[-1:], high=high[-1:], dtype=np.float32)}
+            ),
+        )
+    )
+    return observation_space, action_space
+
 
 class RobomimicEnv(gym.Env):
     def __init__(
@@ -20,12 +148,10 @@ class RobomimicEnv(gym.Env):
         terminate_early: bool = False,
         use_image_obs: Optional[bool] = None,
         horizon: Optional[int] = 500,
+        track_success: bool = True,
     ):
         super().__init__()
-        # Copy env meta code to allow reading from gcp file systems
-        path = os.path.expanduser(path)
-        with h5py.File(tf.io.gfile.GFile(path, "rb"), "r") as f:
-            env_meta = json.loads(f["data"].attrs["env_args"])
+        env_meta = _load_env_meta(os.path.expanduser(path))
         self.use_image_obs = use_image_obs if use_image_obs is not None else env_meta["env_kwargs"]["use_camera_obs"]
         self.env = env_utils.create_env_from_metadata(
             env_meta=env_meta,
@@ -38,88 +164,102 @@ class RobomimicEnv(gym.Env):
         if horizon is not None:
             self.env.horizon = horizon
         self.env._max_episode_steps = self.env.horizon
-        self.terminate_early = terminate_early
-
-        observation_spaces = dict(
-            state=gym.spaces.Dict(
-                {
-                    StateEncoding.EE_POS: gym.spaces.Box(shape=(3,), low=-np.inf, high=np.inf, dtype=np.float32),
-                    StateEncoding.EE_QUAT: gym.spaces.Box(shape=(4,), low=-np.inf, high=np.inf, dtype=np.float32),
-                    StateEncoding.GRIPPER: gym.spaces.Box(shape=(1,), low=-np.inf, high=np.inf, dtype=np.float32),
-                    StateEncoding.JOINT_POS: gym.spaces.Box(shape=(7,), low=-np.inf, high=np.inf, dtype=np.float32),
-                    StateEncoding.JOINT_VEL: gym.spaces.Box(shape=(7,), low=-np.inf, high=np.inf, dtype=np.float32),
-                    StateEncoding.MISC: gym.spaces.Box(
-                        shape=(OBJECT_STATE_SIZE,), low=-np.inf, high=np.inf, dtype=np.float32
-                    ),
-                }
-            ),
-        )
+        self.terminate_early = bool(terminate_early)
+        # Success is only needed if it is reported or used for termination, and can be expensive to check.
+        self.track_success = track_success or terminate_early
+        self._check_success = self.env._check_success
+        self._success_latched = False
+        # Scratch buffer for padding the object state.
+        self._obj_state = np.zeros(OBJECT_STATE_SIZE, dtype=np.float32)
+        self._prev_obj_len = OBJECT_STATE_SIZE
+        # Bind the state keys once to avoid enum attribute lookups in the step loop.
+        self._K_EE_POS = StateEncoding.EE_POS
+        self._K_EE_QUAT = StateEncoding.EE_QUAT
+        self._K_EE_EULER = StateEncoding.EE_EULER
+        self._K_GRIPPER = StateEncoding.GRIPPER
+        self._K_JOINT_POS = StateEncoding.JOINT_POS
+        self._K_JOINT_VEL = StateEncoding.JOINT_VEL
+        self._K_MISC = StateEncoding.MISC
+        # use_image_obs is fixed after construction, so pick the formatter once instead of branching every step.
+        self._format_obs = self._format_image_obs if self.use_image_obs else self._format_state_obs
 
-        if self.use_image_obs:
-            observation_spaces["image"] = gym.spaces.Dict(
-                dict(
-                    agent=gym.spaces.Box(shape=(84, 84, 3), dtype=np.uint8, low=0, high=255),
-                    wrist=gym.spaces.Box(shape=(84, 84, 3), dtype=np.uint8, low=0, high=255),
-                )
-            )
-
-        self.observation_space = gym.spaces.Dict(observation_spaces)
         low, high = self.env.action_spec
-        self.action_space = gym.spaces.Dict(
-            dict(
-                desired_delta=gym.spaces.Dict(
-                    {
-                        StateEncoding.EE_POS: gym.spaces.Box(shape=(3,), low=low[:3], high=high[:3], dtype=np.float32),
-                        StateEncoding.EE_EULER: gym.spaces.Box(
-                            shape=(3,), low=low[3:6], high=high[3:6], dtype=np.float32
-                        ),
-                    }
-                ),
-                desired_absolute=gym.spaces.Dict(
-                    {StateEncoding.GRIPPER: gym.spaces.Box(shape=(1,), low=low[-1:], high=high[-1:], dtype=np.float32)}
-                ),
-            )
+        # The action bounds are fixed, so cache them instead of re-reading the spec every step.
+        self._action_low = np.asarray(low, dtype=np.float32)
+        self._action_high = np.asarray(high, dtype=np.float32)
+        self._action_buf = np.empty(self._action_low.shape, dtype=np.float32)
+        spaces = _build_spaces(
+            bool(self.use_image_obs), tuple(self._action_low.tolist()), tuple(self._action_high.tolist())
         )
+        # Each space carries its own np_random, so copy them to keep seeding and sampling independent per env.
+        self.observation_space, self.action_space = copy.deepcopy(spaces)
 
-    def _format_obs(self, obs):
-        obj_state = np.zeros(OBJECT_STATE_SIZE, dtype=np.float32)
-        obj_state[: obs["object-state"].shape[0]] = obs["object-state"]
-        new_obs = dict(
+    def _format_state_obs(self, obs):
+        # Only the tail written by the previous call needs to be zeroed.
+        _pad_obj_state(self._obj_state, obs["object-state"], self._prev_obj_len)
+        self._prev_obj_len = obs["object-state"].shape[0]
+        # Return a copy since wrappers like HistoryWrapper hold on to previous observations.
+        obj_state = self._obj_state.copy()
+        # robosuite returns float64, cast once here to match the float32 observation space.
+        return dict(
             state={
-                StateEncoding.EE_POS: obs["robot0_eef_pos"],
-                StateEncoding.EE_QUAT: obs["robot0_eef_quat"],
-                StateEncoding.GRIPPER: obs["robot0_gripper_qpos"][..., :1],
-                StateEncoding.JOINT_POS: obs["robot0_joint_pos"],
-                StateEncoding.JOINT_VEL: obs["robot0_joint_vel"],
-                StateEncoding.MISC: obj_state,
+                self._K_EE_POS: np.asarray(obs["robot0_eef_pos"], dtype=np.float32),
+                self._K_EE_QUAT: np.asarray(obs["robot0_eef_quat"], dtype=np.float32),
+                self._K_GRIPPER: np.asarray(obs["robot0_gripper_qpos"][..., :1], dtype=np.float32),
+                self._K_JOINT_POS: np.asarray(obs["robot0_joint_pos"], dtype=np.float32),
+                self._K_JOINT_VEL: np.asarray(obs["robot0_joint_vel"], dtype=np.float32),
+                self._K_MISC: obj_state,
             },
         )
-        if self.use_image_obs:
-            new_obs["image"] = dict(
-                agent=np.flip(obs["agentview_image"], 0), wrist=np.flip(obs["robot0_eye_in_hand_image"], 0)
-            )
+
+    def _format_image_obs(self, obs):
+        new_obs = self._format_state_obs(obs)
+        # Negative-stride views flip the images vertically without the np.flip overhead.
+        new_obs["image"] = dict(agent=obs["agentview_image"][::-1], wrist=obs["robot0_eye_in_hand_image"][::-1])
         return new_obs
 
+    def _format_obs_into(self, obs, out_state: Dict[str, np.ndarray], idx: int, out_image: Optional[Dict] = None):
+        """Writes the formatted observation into row `idx` of caller owned, preallocated batch buffers.
+
+        `out_state` maps each state key to a (N, dim) float32 array and `out_image` maps `agent` and `wrist` to
+        (N, 84, 84, 3) uint8 arrays. This lets a vectorized env emit contiguous batches per field without
+        allocating a dict per env.
+        """
+        out_state[self._K_EE_POS][idx] = obs["robot0_eef_pos"]
+        out_state[self._K_EE_QUAT][idx] = obs["robot0_eef_quat"]
+        out_state[self._K_GRIPPER][idx] = obs["robot0_gripper_qpos"][..., :1]
+        out_state[self._K_JOINT_POS][idx] = obs["robot0_joint_pos"]
+        out_state[self._K_JOINT_VEL][idx] = obs["robot0_joint_vel"]
+        _pad_obj_state(out_state[self._K_MISC][idx], obs["object-state"], OBJECT_STATE_SIZE)
+        if out_image is not None:
+            out_image["agent"][idx] = obs["agentview_image"][::-1]
+            out_image["wrist"][idx] = obs["robot0_eye_in_hand_image"][::-1]
+
     def step(self, action: Dict):
         # For now only allow control via the specific action space we care about.
-        action = np.concatenate(
-            (
-                action["desired_delta"][StateEncoding.EE_POS],
-                action["desired_delta"][StateEncoding.EE_EULER],
-                action["desired_absolute"][StateEncoding.GRIPPER],
-            ),
-            axis=-1,
+        # Fill and clip the preallocated buffer instead of allocating with np.concatenate.
+        buf = self._action_buf
+        desired_delta = action["desired_delta"]
+        # Actions may arrive as tf tensors (e.g. from NormalizationWrapper), which the njit kernel cannot take.
+        _pack_and_clip(
+            buf,
+            np.asarray(desired_delta[self._K_EE_POS]),
+            np.asarray(desired_delta[self._K_EE_EULER]),
+            np.asarray(action["desired_absolute"][self._K_GRIPPER]),
+            self._action_low,
+            self._action_high,
         )
-        low, high = self.env.action_spec
-        action = np.clip(action, a_min=low, a_max=high)
-        obs, reward, done, info = self.env.step(action)
-        success = self.env._check_success()
-        info["success"] = success
-        if self.terminate_early and success:
-            done = True
+        obs, reward, done, info = self.env.step(buf)
+        if self.track_success:
+            # Once an episode has succeeded, skip re-running the (potentially expensive) check.
+            success = self._success_latched or bool(self._check_success())
+            self._success_latched = success
+            info["success"] = success
+            done = bool(done) | (self.terminate_early & success)
         # Never terminate robot envs, but do truncate them.
         return self._format_obs(obs), reward, False, done, info
 
     def reset(self, *args, **kwargs):
         obs = self.env.reset()
+        self._success_latched = False
         return self._format_obs(obs), dict()
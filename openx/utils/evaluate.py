@@ -98,7 +98,7 @@ def eval_policy(
                 # Need to manually check for success
                 success = ep_success[i]
                 if "final_info" in info:
-                    success = success or info["final_info"][i]["success"]
+                    success = success or info["final_info"][i].get("success", False)
                 successes.append(success)
                 ep_reward[i] = 0.0
                 ep_length[i] = 0
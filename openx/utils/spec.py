@@ -1,5 +1,5 @@
 import importlib
-from functools import partial
+from functools import lru_cache, partial
 from typing import Any, Dict, Optional, Tuple, TypedDict, Union
 
 
@@ -81,7 +81,8 @@ class ModuleSpec(TypedDict):
 
     @staticmethod
     def is_module_spec(d: Dict):
-        return isinstance(d, dict) and all([k in d for k in ("module", "name", "args", "kwargs")]) and len(d) == 4
+        # Check the length first, since most dicts seen while instantiating are not module specs.
+        return isinstance(d, dict) and len(d) == 4 and "module" in d and "name" in d and "args" in d and "kwargs" in d
 
 
 def _infer_full_name(o: object):
@@ -94,7 +95,9 @@ def _infer_full_name(o: object):
     )
 
 
+@lru_cache(maxsize=None)
 def _import_from_string(module_string: str, name: str):
+    # Cached since the same callables are resolved many times when instantiating nested configs.
     try:
         module = importlib.import_module(module_string)
         return getattr(module, name)
@@ -106,25 +109,24 @@ def _import_from_string(module_string: str, name: str):
 
 
 def add_kwarg(d: Dict, k: str, v: Any):
+    is_module_spec = ModuleSpec.is_module_spec  # Bind once, this is called for many overrides in sweeps.
     key_parts = k.split(".")
     for key_part in key_parts[:-1]:
-        if ModuleSpec.is_module_spec(d):
+        if is_module_spec(d):
             d = d["kwargs"]
         d = d[key_part]
-    if ModuleSpec.is_module_spec(d):
+    if is_module_spec(d):
         d = d["kwargs"]
     d[key_parts[-1]] = v
 
 
 def recursively_instantiate(obj: Any):
     if ModuleSpec.is_module_spec(obj):
-        spec = ModuleSpec(
-            module=obj["module"],
-            name=obj["name"],
-            args=recursively_instantiate(obj["args"]),
-            kwargs=recursively_instantiate(obj["kwargs"]),
-        )
-        return ModuleSpec.instantiate(spec)()
+        # Call the callable directly, obj was already validated so there is no need to rebuild the spec.
+        cls = _import_from_string(obj["module"], obj["name"])
+        args = recursively_instantiate(obj["args"])
+        kwargs = recursively_instantiate(obj["kwargs"])
+        return cls(*args, **kwargs)
     if isinstance(obj, dict):
         return {k: recursively_instantiate(v) for k, v in obj.items()}
     if isinstance(obj, (tuple, list)):